@@ -3,32 +3,127 @@
 # netbox-custom-objects plugin and reads real columns + Platform relation.
 #
 # Safe to run dry (Commit OFF). Turn Commit ON after you see platform_mappings > 0.
+#
+# To pin the row model instead of discovering it, set ZABBIX_COT_MODEL_LABEL
+# ("app_label.ModelName") in netbox/netbox/local_settings.py. NetBox only copies
+# known parameters from configuration.py into Django settings, so it is ignored there.
 
-from dcim.models import Device, Site, Platform
+from dcim.models import Device, DeviceRole, Site, Platform
 from virtualization.models import VirtualMachine
 from extras.scripts import Script, BooleanVar, ObjectVar
 from django.apps import apps
-from django.db import transaction
-from django.db.models import ForeignKey, ManyToManyField
-
+from django.conf import settings
+from django.core.cache import cache
+from django.db import connection, transaction
+from django.db.models import ForeignKey, ManyToManyField, Q
+from django.db.models.expressions import RawSQL
+from django.db.models.functions import Coalesce
+
+from collections import Counter, defaultdict
+from decimal import Decimal
+from functools import lru_cache
+import json
 import re
 
 COT_TYPE_SELECTOR = "zabbix-template-list"
-
+COT_APP_LABEL = "netbox_custom_objects"
+
+# Discovered plugin models and their field maps, per worker process. netbox-custom-objects
+# rebuilds its table models when a type or its fields change, so entries here (and the
+# _field_names/_slug_map caches) can go stale: tick rescan_catalog to drop them.
+_MODEL_CACHE = {}
+# Chosen row model label shared across worker processes via Django's cache
+CATALOG_CACHE_KEY = "zabbix_cot_row_model_v1:{type_pk}"
+CATALOG_CACHE_TTL = 3600
+
+def _plugin_models():
+    try:
+        return apps.get_app_config(COT_APP_LABEL).get_models()
+    except LookupError:
+        return ()
+
+# "_" is itself outside [a-z0-9], so one pass already collapses underscore runs
+_NON_SLUG_RE = re.compile(r"[^a-z0-9]+")
+# zabbix_extra_templates separator, eating the whitespace around each comma
+_CSV_RE = re.compile(r"\s*,\s*")
+
+@lru_cache(maxsize=2048)
 def _slug(s: str) -> str:
-    s = (s or "").strip().lower()
-    s = re.sub(r"[^a-z0-9]+", "_", s)
-    s = re.sub(r"_+", "_", s).strip("_")
-    return s
+    return _NON_SLUG_RE.sub("_", (s or "").strip().lower()).strip("_")
+
+@lru_cache(maxsize=None)
+def _field_names(Model):
+    return frozenset(f.name for f in Model._meta.get_fields() if hasattr(f, "name"))
+
+@lru_cache(maxsize=None)
+def _slug_map(Model):
+    # slugged field name -> field name (treat as read-only: shared via the cache)
+    return {_slug(n): n for n in _field_names(Model)}
 
 # We’ll match fields by these slugged names
 WANTED = {
-    "name": {"template_name", "name", "template"},
-    "id": {"template_id", "zabbix_template_id", "id"},
-    "iface": {"template_interface_id", "iface_id", "interface_id", "interface"},
-    "platform": {"platform", "platforms"},
+    "name": frozenset({"template_name", "name", "template"}),
+    "id": frozenset({"template_id", "zabbix_template_id", "id"}),
+    "iface": frozenset({"template_interface_id", "iface_id", "interface_id", "interface"}),
+    "platform": frozenset({"platform", "platforms"}),
 }
+# Discovery score per WANTED group present on a candidate model
+WANTED_WEIGHTS = (("name", 2), ("id", 2), ("iface", 1), ("platform", 1))
 IFACE_MAP = {"agent": 1, "snmp": 2, "ipmi": 3, "jmx": 4}
+# mon_req values (JSON bool/number or string, compared case-insensitively) that pass Step 1
+MON_REQ_TRUE = ("1", "true", "yes", "on")
+# CF keys written for objects failing Step 1 (not mon_req / not active)
+STEP1_SKIP_CF = {"mon_req": False, "monitoring_status": "Missing Required Fields"}
+# Rows per bulk_update statement; the Device/VM fetch chunk matches it so
+# each fetched chunk maps onto whole write batches
+BATCH_SIZE = 500
+CHUNK_SIZE = BATCH_SIZE
+CATALOG_CHUNK_SIZE = 1000
+# Object names listed per summary log line
+LOG_NAMES_MAX = 25
+# Device/VM columns the run loop reads, streamed as named rows (no model instances)
+STREAM_FIELDS = ("pk", "name", "status", "platform_id", "role_id",
+                 "primary_ip4_id", "primary_ip6_id", "custom_field_data")
+
+
+def _monitored_q():
+    # Step 1 gate in SQL: status active + mon_req truthy (any case)
+    truthy = Q()
+    for v in MON_REQ_TRUE:
+        truthy |= Q(custom_field_data__mon_req__iexact=v)
+    return Q(status="active") & truthy
+
+
+def _norm_key(s):
+    # Catalog lookup key for a template name
+    return s.strip().lower() if s else ""
+
+
+def _to_int(v):
+    # int for ints / integral Decimals / signed decimal strings, else None -- no exception-driven parsing
+    if isinstance(v, int) and not isinstance(v, bool):
+        return v
+    if isinstance(v, Decimal):
+        # decimal custom-object columns hold e.g. Decimal("12")
+        return int(v) if v.is_finite() and v == v.to_integral_value() else None
+    if isinstance(v, str):
+        s = v.strip()
+        if (s[1:] if s[:1] in "+-" else s).isdecimal():
+            return int(s)
+    return None
+
+
+def _cf_set(cf, key, value):
+    # Set cf[key]; True only if the stored value actually changed
+    if key in cf and cf[key] == value:
+        return False
+    cf[key] = value
+    return True
+
+
+def _needs_write(old, new, overwrite):
+    if overwrite: return True
+    return (old in (None, "", 0)) and (new not in (None, "", 0))
 
 
 class ZabbixCatalogFromCustomObjects(Script):
@@ -42,23 +137,23 @@ class ZabbixCatalogFromCustomObjects(Script):
     limit_site      = ObjectVar(description="Soft limit by Site", required=False, model=Site)
     overwrite       = BooleanVar(description="Overwrite existing values", default=False)
     debug_catalog   = BooleanVar(description="Verbose discovery logs", default=True)
+    rescan_catalog  = BooleanVar(description="Rediscover the catalog model (ignore cached discovery)", default=False)
 
     # ---- small helpers
     def _norm(self, v): return (str(v).strip() if v is not None else "")
-    def _is_true(self, v): return str(v).lower() in {"1","true","yes","on"}
     def _cf(self, obj): return dict(getattr(obj, "custom_field_data", {}) or {})
-    def _role(self, obj): return getattr(obj, "device_role", None) or getattr(obj, "role", None)
-    def _has_primary_ip(self, obj): return bool(getattr(obj, "primary_ip4", None) or getattr(obj, "primary_ip6", None))
 
     # ---- find plugin models
     def _get_type(self):
         # Find the CustomObjectType model and match our type by slug/name/label
-        Type = None
-        for M in apps.get_models():
-            if M._meta.app_label.lower() == "netbox_custom_objects" and "type" in M.__name__.lower() and "field" not in M.__name__.lower():
-                Type = M; break
-        if not Type:
-            raise RuntimeError("CustomObjectType model not found in plugin.")
+        Type = _MODEL_CACHE.get("type")
+        if Type is None:
+            for M in _plugin_models():
+                if "type" in M.__name__.lower() and "field" not in M.__name__.lower():
+                    Type = M; break
+            if not Type:
+                raise RuntimeError("CustomObjectType model not found in plugin.")
+            _MODEL_CACHE["type"] = Type
         fields = {f.name for f in Type._meta.get_fields()}
         for key in ("slug__iexact", "name__iexact", "label__iexact"):
             base = key.split("__",1)[0]
@@ -72,32 +167,48 @@ class ZabbixCatalogFromCustomObjects(Script):
         self.log_warning(f"[COT] Could not match '{COT_TYPE_SELECTOR}'. Using first type id={any_type.pk}.")
         return any_type
 
-    def _choose_dynamic_row_model(self, type_obj, debug=False):
+    def _choose_dynamic_row_model(self, type_obj, debug=False, rescan=False):
         """
         Heuristic: among models in app 'netbox_custom_objects' that are NOT
         Type/Field/Value, choose the one whose field names best match our expected
         columns (template_name/id/interface/platform).
         """
+        cache_key = ("row", type_obj.pk)
+        best = _MODEL_CACHE.get(cache_key)
+        if best is not None:
+            if debug:
+                self.log_info(f"[COT] Cached dynamic model: {best._meta.label}")
+            return best
+
+        shared_key = CATALOG_CACHE_KEY.format(type_pk=type_obj.pk)
+        label = None if rescan else cache.get(shared_key)
+        if label:
+            try:
+                best = apps.get_model(label)
+            except LookupError:
+                best = None     # stale entry (model gone); rediscover below
+            if best is not None:
+                _MODEL_CACHE[cache_key] = best
+                if debug:
+                    self.log_info(f"[COT] Shared-cache dynamic model: {label}")
+                return best
+
         best = None
         best_score = -1
         best_fields = None
 
-        for M in apps.get_models():
-            if M._meta.app_label.lower() != "netbox_custom_objects":
-                continue
+        for M in _plugin_models():
             nm = M.__name__.lower()
             if any(k in nm for k in ("type", "field", "value", "through", "m2m")):
                 continue  # skip meta/through models
 
-            field_names = {f.name for f in M._meta.get_fields() if hasattr(f, "name")}
-            slugs = {_slug(n) for n in field_names}
+            slugs = _slug_map(M)
 
-            # score overlap with targets
+            # score overlap with targets (stop at the first hit per group)
             score = 0
-            score += 2 if slugs & WANTED["name"] else 0
-            score += 2 if slugs & WANTED["id"] else 0
-            score += 1 if slugs & WANTED["iface"] else 0
-            score += 1 if slugs & WANTED["platform"] else 0
+            for key, weight in WANTED_WEIGHTS:
+                if any(w in slugs for w in WANTED[key]):
+                    score += weight
 
             # bonus if it has a relation to dcim.Platform
             for f in M._meta.get_fields():
@@ -106,20 +217,34 @@ class ZabbixCatalogFromCustomObjects(Script):
                     break
 
             if score > best_score:
-                best, best_score, best_fields = M, score, sorted(field_names)
+                best, best_score, best_fields = M, score, sorted(_field_names(M))
 
         if not best or best_score <= 0:
             raise RuntimeError("Could not locate the dynamic table model for this type.")
+        _MODEL_CACHE[cache_key] = best
+        cache.set(shared_key, best._meta.label, CATALOG_CACHE_TTL)
 
         if debug:
             self.log_info(f"[COT] Chosen dynamic model: {best._meta.label} (score={best_score})")
             self.log_info(f"[COT] Dynamic model fields: {best_fields}")
         return best
 
+    def _configured_row_model(self, debug=False):
+        # Explicit settings.ZABBIX_COT_MODEL_LABEL ("app_label.ModelName") skips discovery
+        label = getattr(settings, "ZABBIX_COT_MODEL_LABEL", None)
+        if not label:
+            return None
+        try:
+            Model = apps.get_model(label)
+        except (LookupError, ValueError):
+            raise RuntimeError(f"ZABBIX_COT_MODEL_LABEL '{label}' does not name an installed model.")
+        if debug:
+            self.log_info(f"[COT] Configured dynamic model (ZABBIX_COT_MODEL_LABEL): {Model._meta.label}")
+        return Model
+
     # ---- extractors from dynamic rows
     def _fieldmap(self, Model):
-        names = {f.name for f in Model._meta.get_fields() if hasattr(f, "name")}
-        slug_map = { _slug(n): n for n in names }
+        slug_map = _slug_map(Model)
         pick = lambda wanted: next((slug_map[s] for s in wanted if s in slug_map), None)
         return {
             "name": pick(WANTED["name"]),
@@ -128,58 +253,83 @@ class ZabbixCatalogFromCustomObjects(Script):
             "platform": pick(WANTED["platform"]),
         }
 
-    def _platform_pks_from_row(self, row):
+    def _platform_field(self, Model):
+        """Resolve the Platform relation once per model -> (field name, "m2m"|"fk"|"scalar")."""
+        fields = Model._meta.get_fields()
         # M2M to Platform?
-        for f in row._meta.get_fields():
+        for f in fields:
             if isinstance(f, ManyToManyField) and getattr(f.remote_field, "model", None) is Platform:
-                return list(getattr(row, f.name).values_list("pk", flat=True))
+                return f.name, "m2m"
         # FK to Platform?
-        for f in row._meta.get_fields():
+        for f in fields:
             if isinstance(f, ForeignKey) and getattr(f.remote_field, "model", None) is Platform:
-                obj = getattr(row, f.name, None)
-                return [obj.pk] if obj else []
+                return f.name, "fk"
         # Fallback: integer/digit-string field called platform/platforms
+        names = _field_names(Model)
         for fname in ("platforms", "platform"):
-            if hasattr(row, fname):
-                val = getattr(row, fname)
-                vals = val if isinstance(val, (list, tuple)) else [val]
-                out = []
-                for v in vals:
-                    if isinstance(v, int):
-                        out.append(v)
-                    elif isinstance(v, str) and v.strip().isdigit():
-                        out.append(int(v.strip()))
-                if out:
-                    return out
+            if fname in names:
+                return fname, "scalar"
+        return None, None
+
+    def _platform_pks_fast(self, row, pname, pkind, m2m_pks):
+        if pkind == "m2m":
+            return m2m_pks.get(row["pk"], [])
+        if pkind == "fk":
+            pk = row.get(f"{pname}_id")
+            return [pk] if pk is not None else []
+        if pkind == "scalar":
+            val = row.get(pname)
+            vals = val if isinstance(val, (list, tuple)) else [val]
+            out = []
+            for v in vals:
+                pk = _to_int(v)
+                if pk is not None:
+                    out.append(pk)
+            return out
         return []
 
-    def _load_catalog(self, debug=False):
-        type_obj = self._get_type()
-        RowModel = self._choose_dynamic_row_model(type_obj, debug=debug)
-        fmap = self._fieldmap(RowModel)
+    def _load_catalog(self, debug=False, rescan=False):
+        RowModel = self._configured_row_model(debug=debug)
+        if RowModel is None:
+            if debug:
+                self.log_info("[COT] ZABBIX_COT_MODEL_LABEL not in Django settings; discovering the row model")
+            type_obj = self._get_type()
+            RowModel = self._choose_dynamic_row_model(type_obj, debug=debug, rescan=rescan)
+        # Column mapping + platform relation are schema properties: resolve once per model
+        fields_key = ("fields", RowModel._meta.label)
+        resolved = _MODEL_CACHE.get(fields_key)
+        if resolved is None:
+            resolved = _MODEL_CACHE[fields_key] = (self._fieldmap(RowModel), *self._platform_field(RowModel))
+        fmap, pname, pkind = resolved
         if debug:
             self.log_info(f"[COT] Field mapping used: {fmap}")
+            self.log_info(f"[COT] Platform relation: {pname} ({pkind})")
 
-        name_to_id = {}
-        name_to_iface = {}
+        by_name = {}        # lowercased template name -> (template id, interface id|None)
         by_platform = {}
-
-        rows = list(RowModel.objects.all())
-        for row in rows:
+        has_iface = False
+
+        # Only the mapped columns; M2M platform pks come from one join query
+        cols = ["pk"] + [fmap[k] for k in ("name", "id", "iface") if fmap[k]]
+        if pkind == "fk":
+            cols.append(f"{pname}_id")
+        elif pkind == "scalar":
+            cols.append(pname)
+        m2m_pks = defaultdict(list)
+        if pkind == "m2m":
+            for row_pk, plat_pk in RowModel.objects.filter(**{f"{pname}__isnull": False}).values_list("pk", pname):
+                m2m_pks[row_pk].append(plat_pk)
+
+        for row in RowModel.objects.values(*cols).iterator(chunk_size=CATALOG_CHUNK_SIZE):
             # Template name
             fname = fmap["name"]
-            tname = self._norm(getattr(row, fname, None)) if fname else ""
+            tname = self._norm(row.get(fname)) if fname else ""
             if not tname:
                 continue
 
             # Template ID
             fid = fmap["id"]
-            tid = None
-            if fid:
-                raw = self._norm(getattr(row, fid, None))
-                if raw:
-                    try: tid = int(raw)
-                    except Exception: tid = None
+            tid = _to_int(row.get(fid)) if fid else None
             if tid is None:
                 continue
 
@@ -187,66 +337,120 @@ class ZabbixCatalogFromCustomObjects(Script):
             fif = fmap["iface"]
             tif = None
             if fif:
-                raw = self._norm(getattr(row, fif, None)).lower()
+                raw = self._norm(row.get(fif)).lower()
                 if raw:
-                    if raw.isdigit():
-                        tif = int(raw)
-                    else:
-                        tif = IFACE_MAP.get(raw)
+                    tif = int(raw) if raw.isdecimal() else IFACE_MAP.get(raw)
 
             # Platforms
-            plat_pks = self._platform_pks_from_row(row)
-
-            lname = tname.lower()
-            name_to_id[lname] = tid
-            if tif is not None:
-                name_to_iface[lname] = tif
+            plat_pks = self._platform_pks_fast(row, pname, pkind, m2m_pks)
+
+            lname = _norm_key(tname)
+            if tif is None:
+                tif_keep = by_name.get(lname, (None, None))[1]
+            else:
+                tif_keep = tif; has_iface = True
+            by_name[lname] = (tid, tif_keep)
             for pk in plat_pks:
                 if pk not in by_platform:
                     by_platform[pk] = (tname, tid, tif)
 
         if debug:
-            self.log_info(f"[COT] Catalog built: names={len(name_to_id)}, platform_mappings={len(by_platform)}")
-        return name_to_id, (name_to_iface or None), by_platform
+            self.log_info(f"[COT] Catalog built: names={len(by_name)}, platform_mappings={len(by_platform)}")
+        return by_name, by_platform, has_iface
+
+    def _template_ids_csv(self, primary_name, extra_csv, by_name):
+        """[primary] + extras (by name) -> ("id,id,..." of the catalog hits or "", names not in catalog)."""
+        names = {}      # lowercased names, in first-seen order (dict as ordered set)
+        if primary_name:
+            names[_norm_key(primary_name)] = None
+        if extra_csv:
+            # extra_csv arrives stripped, so the split parts need no further strip
+            names.update(dict.fromkeys(nm.lower() for nm in _CSV_RE.split(extra_csv) if nm))
+
+        get = by_name.get
+        csv = ",".join([str(hit[0]) for nml in names if (hit := get(nml)) is not None])
+        return csv, tuple(nml for nml in names if nml not in by_name)
 
     # ---- SLA + readiness
-    def _ensure_sla(self, obj, cf, overwrite=False):
+    def _role_sla_codes(self):
+        # One JSONField query for every role carrying an SLA code; VMs share dcim.DeviceRole
+        qs = DeviceRole.objects.filter(custom_field_data__sla_report_code__isnull=False) \
+                               .values_list("pk", "custom_field_data__sla_report_code")
+        codes = {}
+        for pk, code in qs:
+            code = self._norm(code)
+            if code:
+                codes[pk] = code
+        return codes
+
+    def _ensure_sla(self, obj, cf, role_codes, overwrite=False):
         cur = self._norm(cf.get("sla_report_code"))
         if cur and not overwrite:
             return cf, False
-        role = self._role(obj)
-        if not role:
-            return cf, False
-        rcf = dict(getattr(role, "custom_field_data", {}) or {})
-        code = self._norm(rcf.get("sla_report_code"))
+        code = role_codes.get(getattr(obj, "role_id", None))
         if not code:
             return cf, False
-        cf["sla_report_code"] = code
-        return cf, True
+        return cf, _cf_set(cf, "sla_report_code", code)
+
+    def _ready_checks(self, obj, cf_after):
+        # (passes?, label) in report order; lazy so callers can stop at the first miss.
+        # status="active" and mon_req=True are not re-checked: rows only reach here
+        # through the _monitored_q() Step 1 filter, and the loop never writes mon_req.
+        norm, get = self._norm, cf_after.get
+        yield bool(obj.primary_ip4_id or obj.primary_ip6_id), "primary IP set"
+        yield obj.platform_id is not None, "platform set"
+        yield bool(norm(get("zabbix_template_name"))), "zabbix_template set"
+        yield bool(norm(get("environment"))), "environment set"
+        yield bool(norm(get("sla_report_code"))), "SLA code set"
+
+    def _is_ready(self, obj, cf_after):
+        # Counter-only path (dry run): short-circuits on the first missing field
+        return all(ok for ok, _ in self._ready_checks(obj, cf_after))
 
     def _ready_eval(self, obj, cf_after):
-        missing = []
-        if self._norm(getattr(obj, "status", "")) != "active": missing.append('status="active"')
-        if not self._has_primary_ip(obj): missing.append("primary IP set")
-        if getattr(obj, "platform_id", None) is None: missing.append("platform set")
-        if not self._is_true(cf_after.get("mon_req")): missing.append("mon_req=True")
-        if not self._norm(cf_after.get("zabbix_template_name")): missing.append("zabbix_template set")
-        if not self._norm(cf_after.get("environment")): missing.append("environment set")
-        if not self._norm(cf_after.get("sla_report_code")): missing.append("SLA code set")
+        # -> (ready?, monitoring_status changed?); cf_after is updated in place
+        missing = [label for ok, label in self._ready_checks(obj, cf_after) if not ok]
         if missing:
-            cf_after["monitoring_status"] = f"Missing Required Fields: {', '.join(missing)}"
-            return False, cf_after
-        cf_after["monitoring_status"] = "Ready"
-        return True, cf_after
+            return False, _cf_set(cf_after, "monitoring_status", f"Missing Required Fields: {', '.join(missing)}")
+        return True, _cf_set(cf_after, "monitoring_status", "Ready")
+
+    # ---- writeback
+    def _flush(self, Model, pending):
+        # pending: {pk: new custom_field_data}; bulk_update only needs pk-bearing instances
+        if not pending:
+            return
+        batch = [Model(pk=pk, custom_field_data=cf) for pk, cf in pending.items()]
+        Model.objects.bulk_update(batch, ["custom_field_data"], batch_size=BATCH_SIZE)
+        pending.clear()
+
+    def _mark_step1_skips(self, Model, pks):
+        # pks: pk subquery of the Step 1 failures; rows already marked are left untouched.
+        # Same constant CF merge for every skipped row -> one UPDATE on Postgres
+        if connection.vendor == "postgresql":
+            Model.objects.filter(pk__in=pks).exclude(custom_field_data__contains=STEP1_SKIP_CF) \
+                 .update(custom_field_data=RawSQL(
+                     "COALESCE(custom_field_data, '{}'::jsonb) || %s::jsonb", [json.dumps(STEP1_SKIP_CF)]))
+            return
+        for obj in Model.objects.filter(pk__in=pks).only("pk", "custom_field_data"):
+            cf = self._cf(obj)
+            if all(cf.get(k) == v for k, v in STEP1_SKIP_CF.items()):
+                continue
+            cf.update(STEP1_SKIP_CF)
+            obj.custom_field_data = cf; obj.save(update_fields=["custom_field_data"])
 
     # ---- object streams
     def _devices(self, site):
-        qs = Device.objects.all().select_related("site","role","platform")
+        qs = Device.objects.all()
         if site: qs = qs.filter(site=site)
         return qs
 
-    def _vms(self):
-        return VirtualMachine.objects.all().select_related("role","platform","cluster__site","site","location__site")
+    def _vms(self, site=None):
+        qs = VirtualMachine.objects.all()
+        if site:
+            # A VM's site is its own, else its location's, else its cluster's -- first non-null wins
+            qs = qs.annotate(effective_site_id=Coalesce("site_id", "location__site_id", "cluster__site_id")) \
+                   .filter(effective_site_id=site.pk)
+        return qs
 
     # ---- main
     def run(self, data, commit):
@@ -256,124 +460,141 @@ class ZabbixCatalogFromCustomObjects(Script):
         overwrite       = data.get("overwrite")
         debug_catalog   = data.get("debug_catalog")
 
-        name_to_id, name_to_iface, by_platform = self._load_catalog(debug=debug_catalog)
+        rescan_catalog  = data.get("rescan_catalog")
+
+        if rescan_catalog:
+            _MODEL_CACHE.clear()
+            _field_names.cache_clear(); _slug_map.cache_clear()
+
+        by_name, by_platform, has_iface = self._load_catalog(debug=debug_catalog, rescan=rescan_catalog)
+        role_codes = self._role_sla_codes()
 
         tmpl_primary_updates = tmpl_primary_skips = 0
         ids_updated = ids_skipped = 0
         status_true = status_false = 0
         step1_skips = step2_skips = 0
         devices_checked = vms_checked = 0
+        unchanged = 0
+
+        no_match = defaultdict(list)     # kind -> names with no catalog match
+        unknown_templates = Counter()    # extra template name -> objects referencing it
+
+        # Objects sharing primary template + extras share the same ids CSV
+        csv_cache = {}
+
+        # Hot-loop lookups bound once
+        norm = self._norm
+        ensure_sla, ready_eval, is_ready = self._ensure_sla, self._ready_eval, self._is_ready
+        template_ids_csv = self._template_ids_csv
+        platform_get, name_get, csv_get = by_platform.get, by_name.get, csv_cache.get
 
         with transaction.atomic():
             streams = []
-            if include_devices: streams.append(("Device", self._devices(limit_site_obj)))
-            if include_vms:     streams.append(("VM", self._vms()))
-
-            for kind, qs in streams:
-                for obj in qs:
-                    if kind == "VM" and limit_site_obj is not None:
-                        sid = getattr(getattr(obj,"site",None),"id",None) \
-                           or getattr(getattr(getattr(obj,"location",None),"site",None),"id",None) \
-                           or getattr(getattr(getattr(obj,"cluster",None),"site",None),"id",None)
-                        if sid != getattr(limit_site_obj,"id",None):
-                            continue
+            if include_devices: streams.append(("Device", Device, self._devices(limit_site_obj)))
+            if include_vms:     streams.append(("VM", VirtualMachine, self._vms(limit_site_obj)))
 
+            for kind, Model, qs in streams:
+                # Step 1: mon_req + active, evaluated in the DB; failures are never hydrated
+                active_qs = qs.filter(_monitored_q())
+                step1_qs = qs.exclude(pk__in=active_qs.values("pk"))
+
+                dirty = {}
+                for obj in active_qs.values_list(*STREAM_FIELDS, named=True).iterator(chunk_size=CHUNK_SIZE):
                     if kind == "Device": devices_checked += 1
                     else:                 vms_checked += 1
 
-                    cf = self._cf(obj)
-
-                    # Step 1: mon_req + active
-                    if not (self._is_true(cf.get("mon_req")) and self._norm(getattr(obj,"status","")) == "active"):
-                        cf["mon_req"] = False
-                        cf["monitoring_status"] = "Missing Required Fields"
-                        step1_skips += 1
-                        if commit:
-                            obj.custom_field_data = cf; obj.save()
-                        continue
+                    # The decoded row dict is ours alone: mutate in place, track real changes
+                    cf = obj.custom_field_data or {}
+                    changed = False
 
                     # Step 2: choose primary by platform
-                    plat_pk = getattr(obj, "platform_id", None)
-                    cur_name = self._norm(cf.get("zabbix_template_name"))
+                    cur_name = norm(cf.get("zabbix_template_name"))
                     cur_int  = cf.get("zabbix_template_int_id", None)
 
                     primary_name = primary_id = primary_iface = None
-                    if plat_pk in by_platform:
-                        primary_name, primary_id, primary_iface = by_platform[plat_pk]
-                    elif cur_name and cur_name.lower() in name_to_id:
-                        primary_name = cur_name
-                        primary_id   = name_to_id.get(cur_name.lower())
-                        primary_iface = name_to_iface.get(cur_name.lower()) if name_to_iface else None
-
-                    def needs_write(old, new):
-                        if overwrite: return True
-                        return (old in (None, "", 0)) and (new not in (None, "", 0))
+                    plat_hit = platform_get(obj.platform_id)
+                    if plat_hit is not None:
+                        primary_name, primary_id, primary_iface = plat_hit
+                    elif cur_name:
+                        hit = name_get(_norm_key(cur_name))
+                        if hit is not None:
+                            primary_name = cur_name
+                            primary_id, primary_iface = hit
 
                     changed_primary = False
                     if primary_name is not None:
-                        if needs_write(cur_name, primary_name):
-                            cf["zabbix_template_name"] = primary_name; changed_primary = True
-                        if name_to_iface is not None and needs_write(cur_int, primary_iface):
-                            cf["zabbix_template_int_id"] = primary_iface; changed_primary = True
-                        if changed_primary and commit:
-                            obj.custom_field_data = cf; obj.save()
+                        if _needs_write(cur_name, primary_name, overwrite):
+                            changed |= _cf_set(cf, "zabbix_template_name", primary_name); changed_primary = True
+                        if has_iface and _needs_write(cur_int, primary_iface, overwrite):
+                            changed |= _cf_set(cf, "zabbix_template_int_id", primary_iface); changed_primary = True
                         tmpl_primary_updates += 1 if changed_primary else 0
                         tmpl_primary_skips   += 0 if changed_primary else 1
                     else:
-                        self.log_info(f"[{kind}] {obj.name}: no catalog match for platform/current name")
+                        no_match[kind].append(obj.name or f"#{obj.pk}")   # Device.name is nullable
                         step2_skips += 1
 
                     # Build zabbix_template_id CSV: [primary] + extras(by name)
-                    names, seen = [], set()
-                    if primary_name:
-                        names.append(primary_name); seen.add(primary_name.lower())
-                    extra_csv = self._norm(cf.get("zabbix_extra_templates"))
-                    if extra_csv:
-                        for nm in [t.strip() for t in extra_csv.split(",") if t.strip()]:
-                            if nm.lower() not in seen:
-                                names.append(nm); seen.add(nm.lower())
-
-                    ids_list = []
-                    for nm in names:
-                        lid = name_to_id.get(nm.lower())
-                        if lid is not None:
-                            ids_list.append(str(lid))
-
-                    if ids_list:
-                        old_csv = self._norm(cf.get("zabbix_template_id"))
-                        new_csv = ",".join(ids_list)
+                    extra_csv = norm(cf.get("zabbix_extra_templates"))
+                    csv_key = (primary_name, extra_csv)
+                    cached = csv_get(csv_key)
+                    if cached is None:
+                        cached = csv_cache[csv_key] = template_ids_csv(primary_name, extra_csv, by_name)
+                    new_csv, unknown = cached
+                    for nml in unknown:
+                        unknown_templates[nml] += 1
+
+                    if new_csv:
+                        old_csv = norm(cf.get("zabbix_template_id"))
                         if overwrite or old_csv != new_csv:
-                            cf["zabbix_template_id"] = new_csv
-                            if commit:
-                                obj.custom_field_data = cf; obj.save()
+                            changed |= _cf_set(cf, "zabbix_template_id", new_csv)
                             ids_updated += 1
                         else:
                             ids_skipped += 1
 
                     # SLA from Role → device CF
-                    cur = self._norm(cf.get("sla_report_code"))
-                    if not cur or overwrite:
-                        role = self._role(obj)
-                        if role:
-                            rcf = dict(getattr(role, "custom_field_data", {}) or {})
-                            code = self._norm(rcf.get("sla_report_code"))
-                            if code:
-                                cf["sla_report_code"] = code
-                                if commit:
-                                    obj.custom_field_data = cf; obj.save()
-
-                    # Final readiness
-                    ok, cf_final = self._ready_eval(obj, cf)
-                    if commit:
-                        obj.custom_field_data = cf_final; obj.save()
+                    cf, sla_changed = ensure_sla(obj, cf, role_codes, overwrite=overwrite)
+                    changed |= sla_changed
+
+                    # Final readiness; a dry run row already known to change only needs the verdict
+                    if changed and not commit:
+                        ok = is_ready(obj, cf)
+                    else:
+                        ok, status_changed = ready_eval(obj, cf)
+                        changed |= status_changed
                     if ok: status_true += 1
                     else:  status_false += 1
 
+                    # Single write per object, flushed in bulk; unchanged objects are skipped
+                    if not changed:
+                        unchanged += 1
+                        continue
+                    if not commit:
+                        continue
+                    dirty[obj.pk] = cf
+                    if len(dirty) >= BATCH_SIZE:
+                        self._flush(Model, dirty)
+
+                # Step 1 failures stay a subquery: one COUNT, plus one UPDATE when committing
+                n_step1 = step1_qs.count()
+                if commit:
+                    self._flush(Model, dirty)
+                    self._mark_step1_skips(Model, step1_qs.values("pk"))
+                step1_skips += n_step1
+                if kind == "Device": devices_checked += n_step1
+                else:                 vms_checked += n_step1
+
             if not commit:
                 self.log_info("Dry run: no changes committed."); transaction.set_rollback(True)
 
+        for kind, names in no_match.items():
+            shown = ", ".join(names[:LOG_NAMES_MAX])
+            more = f" (+{len(names) - LOG_NAMES_MAX} more)" if len(names) > LOG_NAMES_MAX else ""
+            self.log_info(f"[{kind}] no catalog match for platform/current name: {shown}{more}")
+        if unknown_templates:
+            shown = ", ".join(f"{n}×{c}" for n, c in unknown_templates.most_common(LOG_NAMES_MAX))
+            self.log_info(f"Extra templates not in catalog (no id): {shown}")
         self.log_info(f"Template: primary updates={tmpl_primary_updates}, primary skips={tmpl_primary_skips}")
         self.log_info(f"Template IDs: updated={ids_updated}, skipped={ids_skipped}")
         self.log_info(f"Status: Ready={status_true}, NotReady={status_false}; "
                       f"Checked Devices={devices_checked}, VMs={vms_checked}; "
-                      f"Skipped Step1={step1_skips}, Step2={step2_skips}")
+                      f"Skipped Step1={step1_skips}, Step2={step2_skips}; Unchanged={unchanged}")